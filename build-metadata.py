@@ -2,16 +2,20 @@
 
 """ Build per-DRUID metadata .json files for consumption by the Pianolatron app. """
 
-import json
 import logging
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import orjson
 import requests
+import symusic
 from lxml import etree
-from mido import MidiFile, tempo2bpm
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 WRITE_TEMPO_MAPS = False
+SKIP_EXISTING_JSON = False
 
 DRUIDS = [
     "zb497jz4405",
@@ -25,17 +29,72 @@ DRUIDS = [
 
 PURL_BASE = "https://purl.stanford.edu/"
 NS = {"x": "http://www.loc.gov/mods/v3"}
+PARSER = etree.XMLParser(
+    collect_ids=False, remove_blank_text=True, resolve_entities=False
+)
 
 CACHE_MODS = True
 
+# Shared so that cold-cache MODS fetches reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        max_retries=Retry(
+            total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504)
+        )
+    ),
+)
+REQUEST_TIMEOUT = 30
+
+# Compiled once at import (and inherited by worker processes) rather than
+# re-parsed for every MODS document
+XPATHS = {
+    "title": etree.XPath(
+        "(x:titleInfo/x:title)[1]/text()", namespaces=NS, smart_strings=False
+    ),
+    "composer": etree.XPath(
+        "x:name[descendant::x:roleTerm[text()='composer']]/"
+        "x:namePart[not(@type='date')]/text()",
+        namespaces=NS,
+        smart_strings=False,
+    ),
+    "performer": etree.XPath(
+        "x:name[descendant::x:roleTerm[text()='instrumentalist']]/"
+        "x:namePart[not(@type='date')]/text()",
+        namespaces=NS,
+        smart_strings=False,
+    ),
+    "label": etree.XPath(
+        "x:identifier[@type='issue number']/text()",
+        namespaces=NS,
+        smart_strings=False,
+    ),
+}
+
+KEY_VALUE_RE = re.compile(rb"^@([^@\s]+):(?=\s)[^\S\n]*(.*)$", re.M)
+
+HOLE_KEYS = [
+    "NOTE_ATTACK",
+    "WIDTH_COL",
+    "ORIGIN_COL",
+    "ORIGIN_ROW",
+    "OFF_TIME",
+    "TRACKER_HOLE",
+]
+
+# Matches either a hole attribute we keep, capturing the integer value
+# without its optional "px" unit, or the end-of-hole marker
+HOLE_FIELD_RE = re.compile(
+    rf"^(?:@({'|'.join(HOLE_KEYS)}):[^\S\n]+(-?\d+)(?:px)?|(@@END: HOLE))$".encode(),
+    re.M,
+)
+
 
 def get_metadata_for_druid(druid):
     def get_value_by_xpath(xpath):
         try:
-            return xml_tree.xpath(
-                xpath,
-                namespaces=NS,
-            )[0]
+            return xpath(xml_tree)[0]
         except IndexError:
             return None
 
@@ -44,45 +103,27 @@ def get_metadata_for_druid(druid):
     mods_filepath = Path(f"mods/{druid}.mods")
 
     if mods_filepath.exists():
-        xml_tree = etree.parse(mods_filepath.open())
+        xml_tree = etree.parse(str(mods_filepath), PARSER)
     else:
-        response = requests.get(f"{PURL_BASE}{druid}.mods")
-        xml_tree = etree.fromstring(response.content)
+        response = SESSION.get(f"{PURL_BASE}{druid}.mods", timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        xml_tree = etree.fromstring(response.content, PARSER)
         if CACHE_MODS:
-            with mods_filepath.open("r") as _fh:
-                _fh.write(
-                    etree.tostring(xml_tree, encoding="unicode", pretty_print=True)
-                )
-
-    return {
-        "title": get_value_by_xpath("(x:titleInfo/x:title)[1]/text()"),
-        "composer": get_value_by_xpath(
-            "x:name[descendant::x:roleTerm[text()='composer']]/"
-            "x:namePart[not(@type='date')]/text()",
-        ),
-        "performer": get_value_by_xpath(
-            "x:name[descendant::x:roleTerm[text()='instrumentalist']]/"
-            "x:namePart[not(@type='date')]/text()",
-        ),
-        "label": get_value_by_xpath("x:identifier[@type='issue number']/text()"),
-        "PURL": PURL_BASE + druid,
-    }
+            mods_filepath.write_bytes(response.content)
 
+    metadata = {key: get_value_by_xpath(xpath) for key, xpath in XPATHS.items()}
+    metadata["PURL"] = PURL_BASE + druid
 
-def build_tempo_map_from_midi(druid):
+    return metadata
 
-    midi_filepath = Path(f"midi/{druid}.mid")
-    midi = MidiFile(midi_filepath)
 
-    tempo_map = []
-    current_tick = 0
+def build_tempo_map_from_midi(druid):
 
-    for event in midi.tracks[0]:
-        current_tick += event.time
-        if event.type == "set_tempo":
-            tempo_map.append((current_tick, tempo2bpm(event.tempo)))
+    midi_filepath = Path(f"midi/{druid}.mid")
+    score = symusic.Score(str(midi_filepath), ttype="tick")
 
-    return tempo_map
+    # symusic reports tempo changes at absolute ticks, already in BPM
+    return [(tempo.time, tempo.qpm) for tempo in score.tempos]
 
 
 def get_hole_data(druid):
@@ -91,87 +132,88 @@ def get_hole_data(druid):
     if not txt_filepath.exists():
         return None, None
 
-    needed_keys = [
-        "NOTE_ATTACK",
-        "WIDTH_COL",
-        "ORIGIN_COL",
-        "ORIGIN_ROW",
-        "OFF_TIME",
-        "TRACKER_HOLE",
-    ]
-
     roll_data = {}
     hole_data = []
 
     dropped_holes = 0
 
-    with txt_filepath.open("r") as _fh:
-        while (line := _fh.readline()) and line != "@@BEGIN: HOLES\n":
-            if match := re.match(r"^@([^@\s]+):\s+(.*)", line):
-                key, value = match.groups()
-                roll_data[key] = value
-
-        while (line := _fh.readline()) and line != "@@END: HOLES\n":
-            if line == "@@BEGIN: HOLE\n":
-                hole = {}
-            if match := re.match(r"^@([^@\s]+):\s+(.*)", line):
-                key, value = match.groups()
-                if key in needed_keys:
-                    hole[key] = int(value.removesuffix("px"))
-            if line == "@@END: HOLE\n":
-
-                if "NOTE_ATTACK" in hole:
-                    assert "OFF_TIME" in hole
-                    assert hole["NOTE_ATTACK"] == hole["ORIGIN_ROW"]
-                    del hole["NOTE_ATTACK"]
-                    hole_data.append(hole)
-                else:
-                    assert "OFF_TIME" not in hole
-                    dropped_holes += 1
-
-    print(f"Dropped Holes: {dropped_holes}")
+    # Normalize line endings as text-mode reads would, then scan the header
+    # and holes sections in one regex pass each, rather than reading and
+    # matching the file a line at a time
+    txt = txt_filepath.read_bytes().replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    header, _, holes = txt.partition(b"@@BEGIN: HOLES\n")
+    holes = holes.partition(b"@@END: HOLES\n")[0]
+
+    for key, value in KEY_VALUE_RE.findall(header):
+        roll_data[key.decode()] = value.decode()
+
+    hole = {}
+    for key, value, hole_end in HOLE_FIELD_RE.findall(holes):
+        if not hole_end:
+            hole[key.decode()] = int(value)
+            continue
+
+        if "NOTE_ATTACK" in hole:
+            assert "OFF_TIME" in hole
+            assert hole["NOTE_ATTACK"] == hole["ORIGIN_ROW"]
+            del hole["NOTE_ATTACK"]
+            hole_data.append(hole)
+        else:
+            assert "OFF_TIME" not in hole
+            dropped_holes += 1
+        hole = {}
+
+    logging.info(f"{druid}: dropped holes: {dropped_holes}")
     return roll_data, hole_data
 
 
 def remap_hole_data(roll_data, hole_data):
 
-    new_hole_data = []
-
-    for hole in hole_data:
-        new_hole_data.append(
-            {
-                "x": hole["ORIGIN_COL"],
-                "y": hole["ORIGIN_ROW"],
-                "w": hole["WIDTH_COL"],
-                "h": hole["OFF_TIME"] - hole["ORIGIN_ROW"],
-            }
-        )
-
-    return new_hole_data
+    return [
+        {
+            "x": hole["ORIGIN_COL"],
+            "y": hole["ORIGIN_ROW"],
+            "w": hole["WIDTH_COL"],
+            "h": hole["OFF_TIME"] - hole["ORIGIN_ROW"],
+        }
+        for hole in hole_data
+    ]
 
 
 def write_json(druid, metadata, indent=2):
     output_path = Path(f"json/{druid}.json")
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    with output_path.open("w") as _fh:
-        json.dump(metadata, _fh)
+    output_path.write_bytes(orjson.dumps(metadata))
+
+
+def process_druid(druid):
+    if SKIP_EXISTING_JSON and Path(f"json/{druid}.json").is_file():
+        return
+    metadata = get_metadata_for_druid(druid)
+    if WRITE_TEMPO_MAPS:
+        metadata["tempoMap"] = build_tempo_map_from_midi(druid)
+    roll_data, hole_data = get_hole_data(druid)
+    if hole_data:
+        metadata["holeData"] = remap_hole_data(roll_data, hole_data)
+    else:
+        metadata["holeData"] = None
+    write_json(druid, metadata, indent=0)
+
+
+def configure_logging():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 
 def main():
     """ Command-line entry-point. """
 
-    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    configure_logging()
 
-    for druid in DRUIDS:
-        metadata = get_metadata_for_druid(druid)
-        if WRITE_TEMPO_MAPS:
-            metadata["tempoMap"] = build_tempo_map_from_midi(druid)
-        roll_data, hole_data = get_hole_data(druid)
-        if hole_data:
-            metadata["holeData"] = remap_hole_data(roll_data, hole_data)
-        else:
-            metadata["holeData"] = None
-        write_json(druid, metadata, indent=0)
+    # Each DRUID is independent, so fan them out across processes; the
+    # initializer sets up logging in workers that are spawned, not forked
+    with ProcessPoolExecutor(initializer=configure_logging) as executor:
+        for _ in executor.map(process_druid, DRUIDS):
+            pass
 
 
 if __name__ == "__main__":